@@ -1,20 +1,66 @@
 #!/usr/bin/env python
 
 import argparse
+import asyncio
 import glob
+import heapq
 import json
 import os
 import shutil
 import subprocess
+import time
 import uuid
 from collections import OrderedDict
 
-from joblib import delayed
-from joblib import Parallel
 import pandas as pd
 
 import sys
-import random
+import threading
+
+import yt_dlp
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+try:
+    import av
+except ImportError:
+    av = None
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = None
+
+# One YoutubeDL instance per proxy so keep-alive connections are reused
+# across clips that go through the same proxy.
+_YDL_CACHE = {}
+_YDL_LOCK = threading.Lock()
+
+
+def get_ydl(proxy):
+    """Returns a cached YoutubeDL instance configured for the given proxy."""
+    with _YDL_LOCK:
+        ydl = _YDL_CACHE.get(proxy)
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL({'format': '18',  # 640x360 h264 encoded video
+                                    'quiet': True,
+                                    'proxy': proxy})
+            _YDL_CACHE[proxy] = ydl
+        return ydl
+
+
+def is_too_many_requests(err):
+    """Checks whether a DownloadError was caused by an HTTP 429."""
+    exc_info = getattr(err, 'exc_info', None)
+    cause = exc_info[1] if exc_info else None
+    if getattr(cause, 'code', None) == 429 or getattr(cause, 'status', None) == 429:
+        return True
+    return '429' in str(err)
+
 
 def create_video_folders(dataset, output_dir, tmp_dir):
     """Creates a directory for each label name in the dataset."""
@@ -29,161 +75,866 @@ def create_video_folders(dataset, output_dir, tmp_dir):
     if not os.path.exists(tmp_dir):
         os.makedirs(tmp_dir)
 
+    # One scandir instead of an exists()/makedirs() stat pair per label.
+    have = {entry.name for entry in os.scandir(output_dir)}
     label_to_dir = {}
     for label_name in dataset['label-name'].unique():
         this_dir = os.path.join(output_dir, label_name)
-        if not os.path.exists(this_dir):
-            os.makedirs(this_dir)
+        if label_name not in have:
+            os.mkdir(this_dir)
         label_to_dir[label_name] = this_dir
     return label_to_dir
 
 
-def construct_video_filename(row, label_to_dir, trim_format='%06d'):
-    """Given a dataset row, this function constructs the
-       output filename for a given video.
+def construct_video_filenames(dataset, label_to_dir, trim_format='%06d'):
+    """Adds 'basename' and 'dirname' columns to the dataset with vectorized
+       pandas ops, so no per-row formatting is left on the dispatch path.
     """
-    basename = '%s_%s_%s.mp4' % (row['video-id'],
-                                 trim_format % row['start-time'],
-                                 trim_format % row['end-time'])
-    if not isinstance(label_to_dir, dict):
-        dirname = label_to_dir
+    dataset['basename'] = (dataset['video-id'] + '_' +
+                           dataset['start-time'].astype(int).map(
+                               lambda x: trim_format % x) + '_' +
+                           dataset['end-time'].astype(int).map(
+                               lambda x: trim_format % x) + '.mp4')
+    if isinstance(label_to_dir, dict):
+        dataset['dirname'] = dataset['label-name'].map(label_to_dir)
     else:
-        dirname = label_to_dir[row['label-name']]
-    output_filename = os.path.join(dirname, basename)
-    return output_filename
-
-def download_clip(video_identifier, output_filename,
-                  start_time, end_time,
-                  tmp_dir='/tmp/kinetics',
-                  num_attempts=5,
-                  url_base='https://www.youtube.com/watch?v='):
-    """Download a video from youtube if exists and is not blocked.
+        dataset['dirname'] = label_to_dir
+    return dataset
+
+# Encoder args for the re-encode fallback, detected once per run.
+_VIDEO_CODEC = None
+_VIDEO_CODEC_LOCK = threading.Lock()
+
+CPU_VIDEO_CODEC = ['-c:v', 'libx264', '-preset', 'ultrafast']
+
+
+def _encoder_works(codec_args):
+    """Runs a one-frame test encode with the given encoder args.
+
+    'ffmpeg -encoders' only proves an encoder was compiled in; static
+    builds list h264_nvenc on boxes with no NVIDIA GPU, where every
+    invocation fails at runtime.
+    """
+    command = (['ffmpeg', '-hide_banner', '-loglevel', 'error',
+                '-f', 'lavfi', '-i', 'color=c=black:s=128x128:d=0.1',
+                '-frames:v', '1']
+               + codec_args
+               + ['-f', 'null', '-'])
+    try:
+        return subprocess.run(command,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL).returncode == 0
+    except OSError:
+        return False
+
+
+def get_video_codec():
+    """Returns the encoder args for the re-encode fallback, preferring a
+    hardware H.264 encoder when ffmpeg exposes one that actually encodes.
+
+    Offloading the only compute-bound stage to NVENC/QSV frees the CPU
+    cores for more concurrent trims.
+    """
+    global _VIDEO_CODEC
+    with _VIDEO_CODEC_LOCK:
+        if _VIDEO_CODEC is None:
+            try:
+                encoders = subprocess.check_output(
+                    ['ffmpeg', '-hide_banner', '-encoders'],
+                    stderr=subprocess.DEVNULL).decode('utf-8', 'replace')
+            except (OSError, subprocess.CalledProcessError):
+                encoders = ''
+            candidates = [
+                ('h264_nvenc', ['-c:v', 'h264_nvenc', '-preset', 'p1',
+                                '-tune', 'll']),
+                ('h264_qsv', ['-c:v', 'h264_qsv', '-preset', 'veryfast']),
+            ]
+            for name, codec_args in candidates:
+                if name in encoders and _encoder_works(codec_args):
+                    _VIDEO_CODEC = codec_args
+                    break
+            else:
+                # VAAPI would also need device and upload-filter wiring,
+                # so anything else stays on the CPU encoder.
+                _VIDEO_CODEC = CPU_VIDEO_CODEC
+    return _VIDEO_CODEC
+
+
+async def run_command(command, env=None):
+    """Runs an argv list without blocking the event loop (and without an
+    intermediate shell).
+
+    Returns a tuple with the exit code and the combined stdout/stderr.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        env=env,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT)
+    output, _ = await process.communicate()
+    return process.returncode, output
+
+
+RESOLVER_DAEMON_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'resolver_daemon.py')
+
+# One long-lived resolver subprocess per proxy; each entry is a
+# (process, lock) pair so requests on the same daemon are serialized.
+_RESOLVER_DAEMONS = {}
+_RESOLVER_DAEMONS_LOCK = None
+
+
+def _resolver_daemons_lock():
+    # Created lazily from inside a coroutine: before Python 3.10 an
+    # asyncio.Lock binds the loop that exists at construction, so a
+    # module-level instance belongs to the import-time loop and
+    # deadlocks under asyncio.run. Single-threaded loop, no await
+    # between check and assignment, so the check is race-free.
+    global _RESOLVER_DAEMONS_LOCK
+    if _RESOLVER_DAEMONS_LOCK is None:
+        _RESOLVER_DAEMONS_LOCK = asyncio.Lock()
+    return _RESOLVER_DAEMONS_LOCK
+
+
+async def _get_resolver_daemon(proxy):
+    async with _resolver_daemons_lock():
+        entry = _RESOLVER_DAEMONS.get(proxy)
+        if entry is None or entry[0].returncode is not None:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, RESOLVER_DAEMON_SCRIPT, proxy,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE)
+            entry = (process, asyncio.Lock())
+            _RESOLVER_DAEMONS[proxy] = entry
+        return entry
+
+
+async def resolve_via_daemon(video_identifier, proxy, url_base):
+    """Resolves through the proxy's persistent resolver subprocess, which
+    keeps its TLS session to YouTube warm across requests."""
+    process, lock = await _get_resolver_daemon(proxy)
+    async with lock:
+        process.stdin.write(
+            (url_base + video_identifier + '\n').encode('utf-8'))
+        await process.stdin.drain()
+        line = (await process.stdout.readline()).decode('utf-8').strip()
+    if not line:
+        raise yt_dlp.utils.DownloadError(
+            'resolver daemon for proxy {} died'.format(proxy))
+    if line.startswith('ERROR\t'):
+        raise yt_dlp.utils.DownloadError(line.split('\t', 1)[1])
+    return line
+
+
+async def shutdown_resolver_daemons():
+    """Closes every resolver daemon's stdin and waits for it to exit."""
+    global _RESOLVER_DAEMONS_LOCK
+    async with _resolver_daemons_lock():
+        for process, lock in _RESOLVER_DAEMONS.values():
+            if process.returncode is None:
+                process.stdin.close()
+                await process.wait()
+        _RESOLVER_DAEMONS.clear()
+    # Drop the lock with the loop it is bound to.
+    _RESOLVER_DAEMONS_LOCK = None
+
+
+async def resolve_direct_url(video_identifier,
+                             resolver='inprocess',
+                             num_attempts=5,
+                             url_base='https://www.youtube.com/watch?v='):
+    """Resolve the direct download URL of a video if it exists and is
+       not blocked.
     arguments:
     ---------
     video_identifier: str
         Unique YouTube video identifier (11 characters)
-    output_filename: str
-        File path where the video will be stored.
-    start_time: float
-        Indicates the begining time in seconds from where the video
-        will be trimmed.
-    end_time: float
-        Indicates the ending time in seconds of the trimmed video.
+    resolver: str
+        'inprocess' runs yt_dlp on a worker thread; 'daemon' talks to a
+        persistent per-proxy resolver subprocess.
+
+    returns:
+    -------
+    A tuple with the direct URL (None on failure), a log message and the
+    proxy that made the last request.
     """
     # Defensive argument checking.
     assert isinstance(video_identifier, str), 'video_identifier must be string'
-    assert isinstance(output_filename, str), 'output_filename must be string'
     assert len(video_identifier) == 11, 'video_identifier must have length 11'
-    status = False
-    proxy=get_random_proxy()
-    # Construct command line for getting the direct video link.
-    command = ['youtube-dl',
-               '-f', '18', # 640x360 h264 encoded video
-               '--proxy', proxy,
-               '--get-url',
-               '"%s"' % (url_base + video_identifier)]
-    command = ' '.join(command)
-    direct_download_url = None
+    # Either way the resolver keeps its HTTPS connections alive across
+    # clips; the in-process variant blocks, so it runs on a worker thread
+    # off the event loop.
     attempts = 0
+    # The proxy pick can block on a rate-limit token, so keep it off the
+    # event loop. Every retry picks again: that spends a token on each
+    # request and steers away from a proxy the failure just put on
+    # cooldown, instead of hammering it bucket-free.
+    proxy = await asyncio.to_thread(get_random_proxy)
     while True:
-         try:
-            direct_download_url = subprocess.check_output(command,
-                                                          shell=True,
-                                                          stderr=subprocess.STDOUT)
-            direct_download_url = direct_download_url.strip().decode('utf-8')
-         except subprocess.CalledProcessError as err:
-            if "429" in str(err.output):
-               remove_proxy_from_list(proxy)
+        try:
+            if resolver == 'daemon':
+                direct_download_url = await resolve_via_daemon(
+                    video_identifier, proxy, url_base)
+            else:
+                info = await asyncio.to_thread(get_ydl(proxy).extract_info,
+                                               url_base + video_identifier,
+                                               download=False)
+                direct_download_url = info['url']
+            report_proxy_success(proxy)
+            return direct_download_url, 'Resolved', proxy
+        except yt_dlp.utils.DownloadError as err:
+            if is_too_many_requests(err):
+                report_proxy_failure(proxy)
             print('{} - {}, proxy {}'.format(video_identifier, err, proxy), file=sys.stdout)
             attempts += 1
             if attempts == num_attempts:
-                return status, str(err.output)
-            else:
-                continue
-         break
-    # Construct command to trim the videos (ffmpeg required).
-    command = ['http_proxy={}'.format(proxy),
-               'https_proxy={}'.format(proxy),
-               'HTTP_proxy={}'.format(proxy),
-               'HTTPS_proxy={}'.format(proxy),
-               'ffmpeg',
-               '-ss', str(start_time),
-               '-t', str(end_time - start_time),
-               '-i', "'%s'" % direct_download_url,
-               '-c:v', 'libx264', '-preset', 'ultrafast',
-               '-c:a', 'aac',
-               '-threads', '1',
-               '-loglevel', 'panic',
-               '"%s"' % output_filename]
-    command = ' '.join(command)
+                return None, str(err), proxy
+            proxy = await asyncio.to_thread(get_random_proxy)
+
+
+def trim_clips_pyav(direct_download_url, proxy, clips):
+    """Remuxes every requested window of the remote stream with PyAV,
+       opening the source once, without spawning an ffmpeg process.
+
+    'clips' is a list of (start_time, end_time, output_filename, clip_id)
+    tuples. Blocking libav I/O; callers should push this onto a worker
+    thread.
+    """
+    input_container = av.open(direct_download_url,
+                              options={'http_proxy': proxy})
     try:
-        output = subprocess.check_output(command, shell=True,
-                                         stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as err:
-        if "429" in str(err.output):
-            remove_proxy_from_list(proxy)
-        print('{} - {}'.format(video_identifier, err), file=sys.stdout)
-        return status, str(err.output)
-
-    # Check if the video was successfully saved.
-    status = os.path.exists(output_filename)
-    print('{} - downloaded - proxy: {}'.format(video_identifier,proxy ), file=sys.stdout)
-    return status, 'Downloaded'
+        in_streams = [s for s in input_container.streams
+                      if s.type in ('video', 'audio')]
+        for start_time, end_time, output_filename, clip_id in clips:
+            output_container = av.open(output_filename, mode='w')
+            try:
+                out_streams = {
+                    s.index: output_container.add_stream(template=s)
+                    for s in in_streams}
+                # Seek (in AV_TIME_BASE units) to the keyframe at or before
+                # the window start, then remux packets until it ends.
+                input_container.seek(int(start_time * 1000000))
+                start_offsets = {}
+                for packet in input_container.demux(in_streams):
+                    if packet.dts is None:
+                        continue
+                    if (packet.pts is not None and
+                            float(packet.pts * packet.stream.time_base)
+                            >= end_time):
+                        if packet.stream.type == 'video':
+                            break
+                        continue
+                    # Rebase timestamps so the output starts near zero.
+                    offset = start_offsets.setdefault(packet.stream.index,
+                                                      packet.dts)
+                    packet.dts -= offset
+                    if packet.pts is not None:
+                        packet.pts -= offset
+                    packet.stream = out_streams[packet.stream.index]
+                    output_container.mux(packet)
+            finally:
+                output_container.close()
+    finally:
+        input_container.close()
 
-def get_random_proxy():
+
+async def trim_one_clip_ffmpeg(video_identifier, direct_download_url,
+                               proxy, proxy_env,
+                               start_time, end_time, output_filename):
+    """Trims a single window with its own ffmpeg invocation.
+
+    Returns a tuple with the download status and a log message.
+    """
+    # Seeking with -ss before -i makes ffmpeg issue HTTP range requests for
+    # the wanted window only instead of streaming from the beginning.
+    def ffmpeg_command(codec_args):
+        command = ['ffmpeg',
+                   '-ss', str(start_time),
+                   '-i', direct_download_url,
+                   '-t', str(end_time - start_time)]
+        command += codec_args
+        command += ['-threads', '1',
+                    '-loglevel', 'panic',
+                    output_filename]
+        return command
+
+    # Format 18 is already H.264/AAC, so stream-copy first and only pay
+    # for a re-encode when the copy fails (e.g. cut lands mid-GOP).
+    returncode, output = await run_command(ffmpeg_command(['-c', 'copy']),
+                                           env=proxy_env)
+    if returncode != 0:
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+        codec_args = get_video_codec()
+        returncode, output = await run_command(
+            ffmpeg_command(codec_args + ['-c:a', 'aac']),
+            env=proxy_env)
+        if returncode != 0 and codec_args is not CPU_VIDEO_CODEC:
+            # Hardware encoders can still fail at runtime (busy GPU, no
+            # free encode sessions); retry this clip on the CPU.
+            if os.path.exists(output_filename):
+                os.remove(output_filename)
+            returncode, output = await run_command(
+                ffmpeg_command(CPU_VIDEO_CODEC + ['-c:a', 'aac']),
+                env=proxy_env)
+        if returncode != 0:
+            if "429" in str(output):
+                report_proxy_failure(proxy)
+            print('{} - ffmpeg exited with code {}'.format(
+                video_identifier, returncode), file=sys.stdout)
+            return False, str(output)
+    return os.path.exists(output_filename), 'Downloaded'
+
+
+def promote_staged_clip(tmp_filename, output_filename):
+    """Atomically moves a finished trim onto its final path.
+
+    Returns whether the clip landed; a half-written file is deleted
+    instead, so a later resumed run never mistakes it for a download.
+    The stage file lives in the same directory as the final path, so the
+    rename never crosses a filesystem boundary (which would both break
+    atomicity and make os.replace fail with EXDEV).
+    """
+    if os.path.exists(tmp_filename) and os.path.getsize(tmp_filename) > 0:
+        os.replace(tmp_filename, output_filename)
+        return True
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    return False
+
+
+def stage_filename(output_filename):
+    """Returns a throwaway dot-name beside the final path.
+
+    The .mp4 suffix stays last so ffmpeg and PyAV still pick the muxer
+    from the extension.
+    """
+    return os.path.join(os.path.dirname(output_filename),
+                        '.{}.part.mp4'.format(uuid.uuid4().hex))
+
+
+async def trim_clips(video_identifier, direct_download_url, proxy, clips,
+                     backend='ffmpeg'):
+    """Trims every requested window of one resolved video.
+
+    'clips' is a list of (start_time, end_time, output_filename, clip_id)
+    tuples; the source bytes and the resolved URL are shared across all of
+    them. Trims are staged beside their final path and only renamed onto
+    it once complete. Returns a list of (clip_id, status, log) tuples.
+    """
+    staged = [(start_time, end_time, stage_filename(output_filename),
+               clip_id)
+              for start_time, end_time, output_filename, clip_id in clips]
+    finals = [output_filename
+              for start_time, end_time, output_filename, clip_id in clips]
+
+    if backend == 'pyav' and av is not None:
+        try:
+            await asyncio.to_thread(trim_clips_pyav, direct_download_url,
+                                    proxy, staged)
+        except Exception as err:  # libav error classes vary across versions.
+            for start_time, end_time, tmp_filename, clip_id in staged:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+            print('{} - PyAV trim failed ({}), falling back to ffmpeg'.format(
+                video_identifier, err), file=sys.stdout)
+        else:
+            results = []
+            for clip, output_filename in zip(staged, finals):
+                start_time, end_time, tmp_filename, clip_id = clip
+                saved = promote_staged_clip(tmp_filename, output_filename)
+                results.append((clip_id, saved,
+                                'Downloaded' if saved else 'Empty output'))
+            if any(saved for _, saved, _ in results):
+                report_proxy_success(proxy)
+                print('{} - downloaded - proxy: {}'.format(video_identifier,
+                                                           proxy),
+                      file=sys.stdout)
+            return results
+
+    # The proxy goes through the environment instead of a shell prefix.
+    proxy_env = {**os.environ,
+                 'http_proxy': proxy,
+                 'https_proxy': proxy,
+                 'HTTP_PROXY': proxy,
+                 'HTTPS_PROXY': proxy}
+
+    if len(clips) > 1:
+        # One invocation with an output spec per window amortizes the
+        # process startup and the source fetch across all clips of the
+        # same video.
+        command = ['ffmpeg', '-loglevel', 'panic',
+                   '-i', direct_download_url]
+        for start_time, end_time, tmp_filename, clip_id in staged:
+            command += ['-ss', str(start_time),
+                        '-t', str(end_time - start_time),
+                        '-c', 'copy',
+                        '-threads', '1',
+                        tmp_filename]
+        returncode, output = await run_command(command, env=proxy_env)
+        if returncode == 0:
+            results = []
+            for clip, output_filename in zip(staged, finals):
+                start_time, end_time, tmp_filename, clip_id = clip
+                saved = promote_staged_clip(tmp_filename, output_filename)
+                results.append((clip_id, saved,
+                                'Downloaded' if saved else 'Empty output'))
+            report_proxy_success(proxy)
+            print('{} - downloaded - proxy: {}'.format(video_identifier,
+                                                       proxy),
+                  file=sys.stdout)
+            return results
+        if "429" in str(output):
+            report_proxy_failure(proxy)
+        for start_time, end_time, tmp_filename, clip_id in staged:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+    # Single window, or the fused invocation failed: trim each window with
+    # its own invocation so one broken cut cannot sink the others.
+    results = []
+    for clip, output_filename in zip(staged, finals):
+        start_time, end_time, tmp_filename, clip_id = clip
+        saved, log = await trim_one_clip_ffmpeg(video_identifier,
+                                                direct_download_url,
+                                                proxy, proxy_env,
+                                                start_time, end_time,
+                                                tmp_filename)
+        if saved:
+            saved = promote_staged_clip(tmp_filename, output_filename)
+        elif os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        results.append((clip_id, saved, log))
+    if any(saved for _, saved, _ in results):
+        report_proxy_success(proxy)
+        print('{} - downloaded - proxy: {}'.format(video_identifier, proxy),
+              file=sys.stdout)
+    return results
+
+PROXY_FILE = "proxies.txt"
+
+# How long a proxy is deprioritized after a 429.
+PROXY_COOLDOWN_SECONDS = 60.0
+
+# Net failure count (successes subtract) at which a proxy is dropped from
+# proxies.txt for good rather than cooled down again.
+PROXY_MAX_FAILURES = 5
+
+# Token bucket sizing per proxy, tuned to YouTube's observed tolerance.
+PROXY_BUCKET_CAPACITY = 10
+PROXY_BUCKET_REFILL_PER_SEC = 0.5
+# Longest a worker blocks waiting for a token before going ahead anyway.
+PROXY_ACQUIRE_TIMEOUT = 30.0
+
+
+class TokenBucket:
+    """Token bucket with 'capacity' tokens refilled continuously at
+    'refill_per_sec'. Spending a token per request keeps a proxy under its
+    rate limit instead of discovering the limit through 429s.
+    """
+
+    def __init__(self, capacity, refill_per_sec):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _refill_locked(self):
+        now = time.time()
+        self.tokens = min(self.capacity,
+                          self.tokens
+                          + (now - self.updated) * self.refill_per_sec)
+        self.updated = now
+
+    def try_acquire(self):
+        with self.lock:
+            self._refill_locked()
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            return False
+
+    def acquire(self, timeout=PROXY_ACQUIRE_TIMEOUT):
+        """Blocks until a token is available or the timeout passes."""
+        deadline = time.time() + timeout
+        while True:
+            with self.lock:
+                self._refill_locked()
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return True
+                wait = (1.0 - self.tokens) / self.refill_per_sec
+            if time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+# In-memory view of the proxy pool, reloaded only when the file's mtime
+# changes, so workers never touch the filesystem on the hot path. 'stats'
+# maps each proxy to [fail_count, last_used_ts]; 'heap' orders proxies by
+# that pair so the least-failing, least-recently-used proxy is picked
+# first. Stale heap entries are dropped lazily against 'stats'.
+_PROXY_LOCK = threading.Lock()
+_PROXY_CACHE = {'mtime': 0, 'stats': {}, 'heap': [], 'buckets': {}}
+
+
+def _load_proxies_locked():
+    """Reloads the proxy file into the cache if it changed on disk.
+
+    Must be called with _PROXY_LOCK held.
+    """
     try:
-        f = open("proxies.txt", "r")
-    except:
+        mtime = os.stat(PROXY_FILE).st_mtime
+    except OSError:
         print('failed reading proxies.txt file')
         exit(1)
-    text = f.read()
-    f.close()
+    if mtime != _PROXY_CACHE['mtime']:
+        with open(PROXY_FILE, "r") as f:
+            text = f.read()
+        proxies = [p for p in text.split("\n") if p]
+        old_stats = _PROXY_CACHE['stats']
+        old_buckets = _PROXY_CACHE['buckets']
+        stats = {p: old_stats.get(p, [0, 0.0]) for p in proxies}
+        _PROXY_CACHE['mtime'] = mtime
+        _PROXY_CACHE['stats'] = stats
+        _PROXY_CACHE['heap'] = [(s[0], s[1], p) for p, s in stats.items()]
+        heapq.heapify(_PROXY_CACHE['heap'])
+        _PROXY_CACHE['buckets'] = {
+            p: old_buckets.get(p) or TokenBucket(PROXY_BUCKET_CAPACITY,
+                                                 PROXY_BUCKET_REFILL_PER_SEC)
+            for p in proxies}
 
-    proxies = text.split("\n")
-    proxies.remove('')
 
-    proxy = random.choice(proxies)
-    if not proxy:
-        print('no proxy value')
-        exit(1)
-    else:
-        print('Using {} proxy'.format(proxy), file=sys.stdout)
+def get_random_proxy():
+    """Picks the proxy with the lowest failure count and oldest last use,
+    spending one of its rate-limit tokens.
+
+    Proxies whose bucket is empty are skipped; if every bucket is empty the
+    call blocks on the best-ranked proxy's bucket rather than burning the
+    request into a guaranteed 429.
+    """
+    blocked = None
+    with _PROXY_LOCK:
+        _load_proxies_locked()
+        stats = _PROXY_CACHE['stats']
+        heap = _PROXY_CACHE['heap']
+        buckets = _PROXY_CACHE['buckets']
+        proxy = None
+        skipped = []
+        while heap:
+            fail_count, last_used, candidate = heapq.heappop(heap)
+            candidate_stats = stats.get(candidate)
+            if candidate_stats is None:
+                # Proxy left the pool; drop the stale entry.
+                continue
+            if [fail_count, last_used] != candidate_stats:
+                # A fresher entry for this proxy is still in the heap.
+                continue
+            if not buckets[candidate].try_acquire():
+                skipped.append((fail_count, last_used, candidate))
+                continue
+            proxy = candidate
+            candidate_stats[1] = time.time()
+            heapq.heappush(heap, (candidate_stats[0], candidate_stats[1],
+                                  proxy))
+            break
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        if proxy is None:
+            if not skipped:
+                print('no proxy value')
+                exit(1)
+            # Every bucket is tapped out; wait on the best-ranked proxy.
+            blocked = skipped[0][2]
+            blocked_bucket = buckets[blocked]
+    if blocked is not None:
+        blocked_bucket.acquire()
+        with _PROXY_LOCK:
+            blocked_stats = _PROXY_CACHE['stats'].get(blocked)
+            if blocked_stats is not None:
+                blocked_stats[1] = time.time()
+                heapq.heappush(_PROXY_CACHE['heap'],
+                               (blocked_stats[0], blocked_stats[1], blocked))
+        proxy = blocked
+    print('Using {} proxy'.format(proxy), file=sys.stdout)
     return proxy
 
+
+def report_proxy_success(proxy):
+    """Feeds a successful request back so healthy proxies are favoured."""
+    with _PROXY_LOCK:
+        stats = _PROXY_CACHE['stats'].get(proxy)
+        if stats is None or stats[0] == 0:
+            return
+        stats[0] -= 1
+        heapq.heappush(_PROXY_CACHE['heap'], (stats[0], stats[1], proxy))
+
+
+def report_proxy_failure(proxy):
+    """Puts a rate-limited proxy on cooldown, and drops it for good once
+    its failures outrun its successes by PROXY_MAX_FAILURES."""
+    exhausted = False
+    with _PROXY_LOCK:
+        stats = _PROXY_CACHE['stats'].get(proxy)
+        if stats is None:
+            return
+        stats[0] += 1
+        stats[1] = time.time() + PROXY_COOLDOWN_SECONDS
+        if stats[0] >= PROXY_MAX_FAILURES:
+            exhausted = True
+        else:
+            heapq.heappush(_PROXY_CACHE['heap'], (stats[0], stats[1], proxy))
+    # remove_proxy_from_list takes _PROXY_LOCK itself, so call it after
+    # releasing it here.
+    if exhausted:
+        print('Dropping {} proxy after {} failures'.format(
+            proxy, PROXY_MAX_FAILURES), file=sys.stdout)
+        remove_proxy_from_list(proxy)
+
+
+def _rewrite_proxy_file(proxies):
+    with open(PROXY_FILE, "w") as f:
+        for proxy in proxies:
+            f.write(proxy + "\n")
+    with _PROXY_LOCK:
+        _PROXY_CACHE['mtime'] = os.stat(PROXY_FILE).st_mtime
+
+
 def remove_proxy_from_list(proxy):
-    with open("proxies.txt", "r") as f:
-        lines = f.readlines()
-    with open("proxies.txt", "w") as f:
-        for line in lines:
-            if line.strip("\n") != proxy:
-                f.write(line)
-
-
-def download_clip_wrapper(row,
-                          label_to_dir,
-                          trim_format,
-                          tmp_dir,
-                          csv_status_file):
-    """Wrapper for parallel processing purposes."""
-    output_filename = construct_video_filename(row, label_to_dir,
-                                               trim_format)
-    clip_id = os.path.basename(output_filename).split('.mp4')[0]
-    if os.path.exists(output_filename):
-        status = tuple([clip_id, True, 'Exists'])
-        return status
-
-    downloaded, log = download_clip(row['video-id'], output_filename,
-                                    row['start-time'], row['end-time'],
-                                    tmp_dir=tmp_dir)
+    """Drops a proxy from the pool for good and persists the change."""
+    with _PROXY_LOCK:
+        _PROXY_CACHE['stats'].pop(proxy, None)
+        snapshot = list(_PROXY_CACHE['stats'])
+    # Persist on a background thread so the worker is not blocked on the
+    # disk rewrite.
+    threading.Thread(target=_rewrite_proxy_file, args=(snapshot,),
+                     daemon=True).start()
+
+
+def scan_existing_videos(label_to_dir):
+    """Returns the basenames of every already-downloaded clip.
+
+    One scandir per label directory replaces a stat() per dataset row on
+    resumed runs.
+    """
+    if isinstance(label_to_dir, dict):
+        dirnames = label_to_dir.values()
+    else:
+        dirnames = [label_to_dir]
+    existing = set()
+    for dirname in dirnames:
+        for entry in os.scandir(dirname):
+            if entry.name.endswith('.part.mp4'):
+                # Stage file orphaned by a crashed run; never a download.
+                os.remove(entry.path)
+                continue
+            existing.add(entry.name)
+    return existing
+
+
+async def _resolve_group(item, trim_q, status_q, existing, resolver):
+    video_id, clips = item
+    pending = []
+    for clip in clips:
+        start_time, end_time, output_filename, clip_id = clip
+        if os.path.basename(output_filename) in existing:
+            await status_q.put((clip_id, True, 'Exists', video_id))
+        else:
+            pending.append(clip)
+    if not pending:
+        return
+    direct_download_url, log, proxy = await resolve_direct_url(
+        video_id, resolver=resolver)
+    if direct_download_url is None:
+        for start_time, end_time, output_filename, clip_id in pending:
+            await status_q.put((clip_id, False, log, video_id))
+        return
+    await trim_q.put((video_id, proxy, direct_download_url, pending))
+
+
+async def resolver_worker(row_q, trim_q, status_q, existing,
+                          resolver='inprocess'):
+    """Pulls per-video clip groups, resolves each direct URL once and
+       feeds the trimming stage."""
+    while True:
+        item = await row_q.get()
+        if item is None:
+            break
+        try:
+            await _resolve_group(item, trim_q, status_q, existing, resolver)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            # A dead worker would starve the bounded queues and hang the
+            # whole pipeline, so report the group as failed and move on.
+            # (A clip already reported above may get a second record;
+            # harmless, the status file is keyed by video id.)
+            video_id, clips = item
+            print('{} - resolver error: {}'.format(video_id, err),
+                  file=sys.stdout)
+            for start_time, end_time, output_filename, clip_id in clips:
+                await status_q.put((clip_id, False, str(err), video_id))
 
+
+async def trimmer_worker(trim_q, status_q, backend='ffmpeg'):
+    """Pulls resolved URLs and runs the trims."""
+    while True:
+        item = await trim_q.get()
+        if item is None:
+            break
+        video_id, proxy, direct_download_url, clips = item
+        try:
+            results = await trim_clips(video_id, direct_download_url, proxy,
+                                       clips, backend=backend)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            # Same reasoning as in resolver_worker: fail the clips, keep
+            # the worker alive.
+            print('{} - trimmer error: {}'.format(video_id, err),
+                  file=sys.stdout)
+            results = [(clip_id, False, str(err))
+                       for start_time, end_time, output_filename, clip_id
+                       in clips]
+        for clip_id, downloaded, log in results:
+            await status_q.put((clip_id, downloaded, log, video_id))
+
+
+# How many status records the writer drains per batch.
+STATUS_BATCH_SIZE = 256
+
+
+class UringAppender:
+    """File appender backed by io_uring: writes become queued SQEs that are
+    submitted to the kernel in groups, so individual record batches cost no
+    write() syscall. Completions are reaped on the same thread at submit
+    time.
+    """
+
+    QUEUE_DEPTH = 256
+    SUBMIT_EVERY = 128
+
+    def __init__(self, filename):
+        self.fd = os.open(filename,
+                          os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.ring = liburing.io_uring()
+        liburing.io_uring_queue_init(self.QUEUE_DEPTH, self.ring, 0)
+        self.cqes = liburing.io_uring_cqes()
+        self.pending = []
+
+    def write(self, data):
+        buf = bytearray(data.encode('utf-8'))
+        sqe = liburing.io_uring_get_sqe(self.ring)
+        liburing.io_uring_prep_write(sqe, self.fd, buf, len(buf), -1)
+        # Completions can arrive out of order; tag each SQE with its slot
+        # so the result can be checked against the right buffer.
+        sqe.user_data = len(self.pending)
+        # Keep the buffer alive until its completion is reaped.
+        self.pending.append(buf)
+        if len(self.pending) >= self.SUBMIT_EVERY:
+            self._submit()
+
+    def flush(self):
+        # Batching is the point: only hit the kernel once enough SQEs have
+        # queued up. close() forces out whatever remains.
+        if len(self.pending) >= self.SUBMIT_EVERY:
+            self._submit()
+
+    def _submit(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        liburing.io_uring_submit(self.ring)
+        for _ in pending:
+            liburing.io_uring_wait_cqe(self.ring, self.cqes)
+            cqe = self.cqes[0]
+            index, res = cqe.user_data, cqe.res
+            liburing.io_uring_cqe_seen(self.ring, cqe)
+            if res < 0:
+                # The status file is the resume journal; losing records
+                # silently would re-download or skip the wrong clips.
+                raise OSError(-res, 'io_uring status append failed: {}'
+                              .format(os.strerror(-res)))
+            buf = pending[index]
+            if res < len(buf):
+                # Short write: finish the tail synchronously instead of
+                # dropping bytes from the journal.
+                view = memoryview(buf)[res:]
+                while view:
+                    written = os.write(self.fd, view)
+                    view = view[written:]
+
+    def close(self):
+        self._submit()
+        liburing.io_uring_queue_exit(self.ring)
+        os.close(self.fd)
+
+
+def open_status_file(csv_status_file, use_uring):
+    """Opens the status file for appending, through io_uring if requested."""
+    if use_uring:
+        if liburing is None:
+            print('liburing not available, falling back to buffered writes',
+                  file=sys.stdout)
+        else:
+            return UringAppender(csv_status_file)
+    return open(csv_status_file, 'a', buffering=65536)
+
+
+async def status_worker(status_q, csv_status_file, use_uring=False,
+                        report_filename='download_report.jsonl'):
+    """Single owner of the status and report files; batches and serializes
+    all appends.
+
+    The files are opened once and records are drained in batches, so
+    workers never pay an open/write/close per clip. Each status is
+    streamed out as one JSON line the moment it completes, so the full
+    report never sits in memory. With use_uring the status appends go
+    through io_uring and skip even the per-batch write() syscall.
+
+    Returns a tuple with the number of succeeded and failed clips.
+    """
     error_429_message = "HTTP Error 429: Too Many Requests"
-    if csv_status_file is not None and error_429_message not in log:
-        with open(csv_status_file, 'a') as f:
-            f.write('\n{}, {}'.format(
-                row['video-id'], str(log).replace(',', '.')
-            ))
-    status = tuple([clip_id, downloaded, log])
-    return status
+    status_file = None
+    if csv_status_file is not None:
+        status_file = open_status_file(csv_status_file, use_uring)
+    report_file = open(report_filename, 'w', buffering=65536)
+    succeeded = 0
+    failed = 0
+    done = False
+    while not done:
+        batch = [await status_q.get()]
+        while len(batch) < STATUS_BATCH_SIZE:
+            try:
+                batch.append(status_q.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        lines = []
+        report_lines = []
+        for item in batch:
+            if item is None:
+                done = True
+                continue
+            clip_id, downloaded, log, video_id = item
+            if downloaded:
+                succeeded += 1
+            else:
+                failed += 1
+            report_lines.append(
+                json.dumps([clip_id, downloaded, str(log)]) + '\n')
+            if status_file is not None and error_429_message not in str(log):
+                lines.append('\n{}, {}'.format(video_id,
+                                               str(log).replace(',', '.')))
+        if status_file is not None and lines:
+            status_file.write(''.join(lines))
+            status_file.flush()
+        if report_lines:
+            report_file.write(''.join(report_lines))
+            report_file.flush()
+    if status_file is not None:
+        status_file.close()
+    report_file.close()
+    return succeeded, failed
 
 
 def parse_kinetics_annotations(input_csv, ignore_is_cc=False):
@@ -201,7 +952,18 @@ def parse_kinetics_annotations(input_csv, ignore_is_cc=False):
         Pandas with the following columns:
             'video-id', 'start-time', 'end-time', 'label-name'
     """
-    df = pd.read_csv(input_csv)
+    if pa is not None:
+        # PyArrow parses the CSV multi-threaded and hands the columns to
+        # pandas without a copy; worthwhile for the 500k-row annotations.
+        table = pa_csv.read_csv(
+            input_csv,
+            read_options=pa_csv.ReadOptions(use_threads=True),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={'time_start': pa.int32(),
+                              'time_end': pa.int32()}))
+        df = table.to_pandas(split_blocks=True, self_destruct=True)
+    else:
+        df = pd.read_csv(input_csv)
     if 'youtube_id' in df.columns:
         columns = OrderedDict([
             ('youtube_id', 'video-id'),
@@ -215,53 +977,104 @@ def parse_kinetics_annotations(input_csv, ignore_is_cc=False):
 
 
 def main(input_csv, output_dir,
-         trim_format='%06d', num_jobs=24, tmp_dir='/tmp/kinetics',
-         drop_duplicates=False, csv_status_file=None):
+         trim_format='%06d', num_jobs=512, tmp_dir='/tmp/kinetics',
+         drop_duplicates=False, csv_status_file=None, use_uring=False,
+         backend='ffmpeg', resolver='inprocess'):
+
+    if backend == 'pyav' and av is None:
+        print('PyAV not available, falling back to ffmpeg', file=sys.stdout)
+        backend = 'ffmpeg'
+
+    # Probe the available encoders once, before any worker needs them.
+    print('Using {} for re-encode fallbacks'.format(get_video_codec()[1]),
+          file=sys.stdout)
 
     # Reading and parsing Kinetics.
     dataset = parse_kinetics_annotations(input_csv)
-    # if os.path.isfile(drop_duplicates):
-    #     print('Attempt to remove duplicates')
-    #     old_dataset = parse_kinetics_annotations(drop_duplicates,
-    #                                              ignore_is_cc=True)
-    #     df = pd.concat([dataset, old_dataset], axis=0, ignore_index=True)
-    #     df.drop_duplicates(inplace=True, keep=False)
-    #     print(dataset.shape, old_dataset.shape)
-    #     dataset = df
-    #     print(dataset.shape)
-
-    # Creates folders where videos will be saved later.
+    if isinstance(drop_duplicates, str) and os.path.isfile(drop_duplicates):
+        print('Attempt to remove duplicates')
+        # A set difference over just the video ids; the old concat +
+        # drop_duplicates route copied both frames to do the same thing.
+        old_ids = set(parse_kinetics_annotations(drop_duplicates,
+                                                 ignore_is_cc=True)['video-id'])
+        dataset = dataset[~dataset['video-id'].isin(old_ids)]
+        dataset = dataset.reset_index(drop=True)
+        print(dataset.shape)
+
+    # Creates folders where videos will be saved later. The test-set branch
+    # of create_video_folders skips tmp_dir, but the cleanup below expects
+    # it to exist.
     label_to_dir = create_video_folders(dataset, output_dir, tmp_dir)
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
 
     if csv_status_file is not None:
         if not os.path.exists(csv_status_file):
             with open(csv_status_file, 'a') as f:
                 f.write('video_identifier, status')
         status_df = pd.read_csv(csv_status_file)
-        index_values = dataset[dataset['video-id'].isin(
-            status_df.video_identifier.unique())].index
-        dataset = dataset.drop(index_values).reset_index(drop=True)
-
-    # Download all clips.
-    if num_jobs == 1:
-        status_lst = []
-        for i, row in dataset.iterrows():
-            status_lst.append(download_clip_wrapper(row, label_to_dir,
-                                                    trim_format, tmp_dir,
-                                                    csv_status_file))
-    else:
-        status_lst = Parallel(n_jobs=num_jobs)(delayed(download_clip_wrapper)(
-            row, label_to_dir,
-            trim_format, tmp_dir,
-            csv_status_file) for i, row in dataset.iterrows())
+        # Hash-indexed isin plus one boolean mask; the old index lookup
+        # followed by drop() walked and copied the frame twice.
+        status_ids = pd.Index(status_df.video_identifier.unique())
+        dataset = dataset[~dataset['video-id'].isin(status_ids)]
+        dataset = dataset.reset_index(drop=True)
+
+    # Precompute every output path in one vectorized pass.
+    dataset = construct_video_filenames(dataset, label_to_dir, trim_format)
+
+    # Snapshot what is already on disk before dispatching any work.
+    existing = scan_existing_videos(label_to_dir)
+
+    # Download all clips. URL resolution (network-bound) and ffmpeg trims
+    # (CPU-bound) run as separate stage pools joined by a bounded queue, so
+    # the next downloads overlap with the trims still in flight. num_jobs
+    # bounds the resolver pool; the trimmer pool is sized to the CPUs.
+    async def _gather():
+        num_trimmers = os.cpu_count()
+        row_q = asyncio.Queue(maxsize=1024)
+        trim_q = asyncio.Queue(maxsize=2 * num_trimmers)
+        status_q = asyncio.Queue()
+
+        writer = asyncio.create_task(
+            status_worker(status_q, csv_status_file, use_uring=use_uring))
+        trimmers = [asyncio.create_task(
+                        trimmer_worker(trim_q, status_q, backend=backend))
+                    for _ in range(num_trimmers)]
+        resolvers = [asyncio.create_task(
+                         resolver_worker(row_q, trim_q, status_q, existing,
+                                         resolver=resolver))
+                     for _ in range(num_jobs)]
+
+        # Plain tuples are far cheaper to build than the pd.Series that
+        # iterrows materializes per row. Clips that share a YouTube id are
+        # grouped so the URL is resolved and the source fetched only once.
+        columns = ['start-time', 'end-time', 'basename', 'dirname']
+        for video_id, group in dataset.groupby('video-id', sort=False):
+            clips = [(start_time, end_time,
+                      os.path.join(dirname, basename),
+                      basename.split('.mp4')[0])
+                     for start_time, end_time, basename, dirname
+                     in group[columns].itertuples(index=False, name=None)]
+            await row_q.put((video_id, clips))
+        for _ in resolvers:
+            await row_q.put(None)
+        await asyncio.gather(*resolvers)
+        await shutdown_resolver_daemons()
+        for _ in trimmers:
+            await trim_q.put(None)
+        await asyncio.gather(*trimmers)
+        await status_q.put(None)
+        return await writer
+
+    # The report is streamed to download_report.jsonl as clips complete,
+    # so only the success/failure counts come back.
+    succeeded, failed = asyncio.run(_gather())
+    print('{} clips succeeded, {} failed'.format(succeeded, failed),
+          file=sys.stdout)
 
     # Clean tmp dir.
     shutil.rmtree(tmp_dir)
 
-    # Save download report.
-    with open('download_report.json', 'w') as fobj:
-        fobj.write(json.dumps(status_lst))
-
 
 if __name__ == '__main__':
     description = 'Helper script for downloading and trimming kinetics videos.'
@@ -275,12 +1088,23 @@ if __name__ == '__main__':
                    help=('This will be the format for the '
                          'filename of trimmed videos: '
                          'videoid_%0xd(start_time)_%0xd(end_time).mp4'))
-    p.add_argument('-n', '--num-jobs', type=int, default=24)
+    p.add_argument('-n', '--num-jobs', type=int, default=512,
+                   help='Maximum number of clips in flight at once.')
     p.add_argument('-t', '--tmp-dir', type=str, default='/tmp/kinetics')
     p.add_argument('--drop-duplicates', type=str, default='non-existent',
-                   help='Unavailable at the moment')
-                   # help='CSV file of the previous version of Kinetics.')
+                   help='CSV file of the previous version of Kinetics.')
     p.add_argument('-c', '--csv-status-file', type=str,
                    help='CSV file containing files that have been already'
                         'processed')
+    p.add_argument('--backend', type=str, default='ffmpeg',
+                   choices=['ffmpeg', 'pyav'],
+                   help='Trim clips with an ffmpeg subprocess or in-process '
+                        'with PyAV (requires the av package).')
+    p.add_argument('--resolver', type=str, default='inprocess',
+                   choices=['inprocess', 'daemon'],
+                   help='Resolve URLs with yt_dlp in-process or through one '
+                        'persistent resolver subprocess per proxy.')
+    p.add_argument('--use-uring', action='store_true',
+                   help='Append to the status file through io_uring '
+                        '(requires the liburing package).')
     main(**vars(p.parse_args()))
@@ -39,7 +39,7 @@ status_and_reason_to_message_dict = {
     }
 
 def get_status_and_reason(msg):
-    for s_r, lst in status_and_reason_to_message_dict.iteritems():
+    for s_r, lst in status_and_reason_to_message_dict.items():
         if any([x in msg for x in lst]):
             return s_r
 
@@ -55,11 +55,30 @@ def process_download_report(report):
     return output
 
 
+def load_download_report(report_file):
+    """Loads a download report, either the streamed JSONL format that
+       download.py writes (one record per line) or the legacy single
+       JSON array.
+
+    The first byte is no tell: each JSONL record is itself a JSON array.
+    Try the per-line parse first; a legacy report pretty-printed across
+    lines fails it, and a legacy report on a single line is recognized by
+    its elements being lists (records are [name, status, message])."""
+    with open(report_file, 'r') as fobj:
+        lines = [line for line in fobj if line.strip()]
+    try:
+        records = [json.loads(line) for line in lines]
+    except ValueError:
+        return json.loads(''.join(lines))
+    if len(records) == 1 and records[0] and isinstance(records[0][0], list):
+        return records[0]
+    return records
+
+
 def wrapper_process_download_reports(json_files):
     all_ouputs = []
     for f in json_files:
-        with open(f, 'r') as fobj:
-            report = json.load(fobj)
+        report = load_download_report(f)
         all_ouputs += process_download_report(report)
     return all_ouputs
 
@@ -101,8 +120,9 @@ if __name__ == '__main__':
                    help=('CSV file containing the following format: ' 
                          'label,   youtube_id,  time_start,  time_end,    split,   is_cc'))
     p.add_argument('input_json', type=str,
-                   help=('base name for download report json files'),
-                   default='download_report.json')
+                   help=('base name for download report files '
+                         '(JSONL as written by download.py)'),
+                   default='download_report.jsonl')
     p.add_argument('output_file', type=str,
                    help='Output csv file with statuses and reasons.')
     p.add_argument('-f', '--trim-format', type=str, default='%06d',
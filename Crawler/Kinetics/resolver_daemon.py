@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+"""Long-lived yt_dlp resolver used by download.py.
+
+Reads one watch URL per line on stdin and prints the direct format-18
+URL (or 'ERROR<TAB>message') per line on stdout. Keeping the process
+alive lets yt_dlp reuse its TCP/TLS session to YouTube across thousands
+of requests, so a resolve costs a warm round-trip instead of a fresh
+handshake.
+"""
+
+import argparse
+import sys
+
+import yt_dlp
+
+
+def main(proxy):
+    ydl = yt_dlp.YoutubeDL({'format': '18',  # 640x360 h264 encoded video
+                            'quiet': True,
+                            'proxy': proxy})
+    for line in sys.stdin:
+        url = line.strip()
+        if not url:
+            continue
+        try:
+            info = ydl.extract_info(url, download=False)
+            print(info['url'], flush=True)
+        except yt_dlp.utils.DownloadError as err:
+            print('ERROR\t{}'.format(str(err).replace('\n', ' ')),
+                  flush=True)
+
+
+if __name__ == '__main__':
+    description = 'Persistent URL resolver for downloading kinetics videos.'
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('proxy', type=str, nargs='?', default=None,
+                   help='Proxy routed through yt_dlp for every request.')
+    main(**vars(p.parse_args()))